@@ -4,63 +4,214 @@ import plotly.express as px
 import plotly.graph_objs as go
 import dash
 from dash import dcc, html, Input, Output
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
 from datetime import datetime
+from functools import lru_cache
+import os
 
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-app.title = "Dashboard de Ondas de Calor"
-print("Aplicativo WSGI inicializado:", app.server)  # Debug
-
 # Carregar dados
 excel_path = "banco_dados_climaticos_consolidado (2).xlsx"
+# Cópia em Parquet do Excel já tratado: evita reprocessar o XLSX a cada inicialização
+parquet_path = "banco_dados_climaticos_consolidado.parquet"
+# Só as colunas usadas pelo dashboard (o Excel tem 26): reduz o DataFrame e o cache Parquet.
+# A leitura do XLSX continua lenta, pois o openpyxl percorre a planilha inteira mesmo assim.
+COLUNAS = ["index", "cidade", "Lat", "Long", "tempMax", "tempMed", "tempMin", "isHW"]
+
+# Tipos esperados no cache; um Parquet gravado por versão anterior do load_data é descartado
+TIPOS = {
+    "tempMax": "float32", "tempMed": "float32", "tempMin": "float32",
+    "Lat": "float32", "Long": "float32", "year": "int16", "month": "int8", "isHW": "bool"
+}
+
+def cache_valido(df):
+    return (
+        set(df.columns) == set(COLUNAS) | {"year", "month"}
+        and all(str(df[c].dtype) == t for c, t in TIPOS.items())
+        and isinstance(df["cidade"].dtype, pd.CategoricalDtype)
+        and pd.api.types.is_datetime64_dtype(df["index"])
+    )
 
 def load_data():
-    df = pd.read_excel(excel_path)
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(excel_path):
+        try:
+            df = pd.read_parquet(parquet_path, engine="pyarrow")
+            if cache_valido(df):
+                return df
+            print("Cache Parquet desatualizado, relendo o Excel")  # Debug
+        except (OSError, ValueError) as e:
+            print("Cache Parquet ilegível, relendo o Excel:", e)  # Debug
+
+    df = pd.read_excel(excel_path, usecols=COLUNAS)
     df["index"] = pd.to_datetime(df["index"], errors="coerce")
-    df["isHW"] = df["isHW"].apply(lambda x: str(x).upper())
+    df = df.dropna(subset=["index"])
+    df["isHW"] = df["isHW"].astype(str).str.upper().eq("TRUE").to_numpy()
     df["year"] = df["index"].dt.year
     df["month"] = df["index"].dt.month
+    df["cidade"] = df["cidade"].astype("category")
+    # Tipos compactos: temperaturas cabem em float32 e ano/mês em inteiros pequenos
+    df = df.astype(TIPOS)
+    # Grava em arquivo temporário e troca de uma vez, para nunca deixar um Parquet pela metade
+    tmp_path = parquet_path + ".tmp"
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp_path, parquet_path)
+    except OSError as e:
+        print("Não foi possível salvar o cache Parquet:", e)  # Debug
     return df
 
 df = load_data()
-cidades = sorted(df["cidade"].unique())
-anos = sorted(df["year"].unique())
+cidades = list(df["cidade"].cat.categories)
+ano_min, ano_max = int(df["year"].min()), int(df["year"].max())
+
+# Índices por cidade: evitam varrer o DataFrame inteiro a cada callback
+CITY_FRAMES = {c: g.sort_values("index") for c, g in df.groupby("cidade", sort=False, observed=True)}
+# Posição da primeira linha de cada ano (ano_min..ano_max+1) em cada frame ordenado
+CITY_YEAR_OFFSETS = {
+    c: np.searchsorted(g["year"].to_numpy(), np.arange(ano_min, ano_max + 2), "left")
+    for c, g in CITY_FRAMES.items()
+}
+
+def city_slice(cidade, ano_inicio, ano_fim):
+    offsets = CITY_YEAR_OFFSETS[cidade]
+    lo = offsets[min(max(ano_inicio - ano_min, 0), len(offsets) - 1)]
+    hi = offsets[min(max(ano_fim + 1 - ano_min, 0), len(offsets) - 1)]
+    return CITY_FRAMES[cidade].iloc[lo:hi]
 
 # Funções auxiliares
-def calculate_anomalies(df, cidade, ano_inicio, ano_fim):
-    dff = df[(df["cidade"] == cidade) & (df["year"] >= ano_inicio) & (df["year"] <= ano_fim)]
-    baseline = dff["tempMed"].mean()
-    df_anomalia = dff.groupby("year")["tempMed"].mean().reset_index()
-    df_anomalia["anomalia"] = df_anomalia["tempMed"] - baseline
-    return df_anomalia
-
-def calculate_hw_monthly(df, cidade, ano):
-    dff = df[(df["cidade"] == cidade) & (df["year"] == ano) & (df["isHW"] == "TRUE")].copy()
-    dff["mes"] = dff["index"].dt.strftime("%B")  # Nome do mês em inglês
-    monthly_counts = dff.groupby("mes").size().reset_index(name="frequencia")
-    all_months = [
-        "January", "February", "March", "April", "May", "June",
-        "July", "August", "September", "October", "November", "December"
-    ]
-    monthly_counts = pd.DataFrame({"mes": all_months}).merge(
-        monthly_counts, on="mes", how="left"
-    ).fillna({"frequencia": 0})
-    return monthly_counts
-
-def dias_ondas_calor(df, cidade):
-    return df[(df["cidade"] == cidade) & (df["isHW"] == "TRUE")]["index"].dt.date.tolist()
-
-def prepare_heatmap_data(df):
-    df_heatmap = df[df["isHW"] == "TRUE"].groupby(["cidade", "year"]).size().reset_index(name="dias_hw")
-    all_combinations = pd.MultiIndex.from_product([cidades, range(1981, 2024)], names=["cidade", "year"]).to_frame(index=False)
-    df_heatmap = all_combinations.merge(df_heatmap, on=["cidade", "year"], how="left").fillna({"dias_hw": 0})
-    return df_heatmap
+ALL_MONTHS = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December"
+]
+
+def anomaly_kernel(years, temps):
+    # Médias anual e do período numa única passada (years já vem ordenado)
+    if len(years) == 0:
+        return years, temps, temps
+    validos = ~np.isnan(temps)
+    anos_unicos, inicio = np.unique(years, return_index=True)
+    somas = np.add.reduceat(np.where(validos, temps, 0.0), inicio)
+    contagens = np.add.reduceat(validos.astype(np.int64), inicio)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        medias = somas / contagens
+        baseline = somas.sum() / contagens.sum()
+    return anos_unicos, medias, medias - baseline
+
+@lru_cache(maxsize=256)
+def anomaly_arrays(cidade, ano_inicio, ano_fim):
+    dff = city_slice(cidade, ano_inicio, ano_fim)
+    return anomaly_kernel(
+        dff["year"].to_numpy(dtype=np.int64), dff["tempMed"].to_numpy(dtype=np.float64)
+    )
+
+def calculate_anomalies(cidade, ano_inicio, ano_fim):
+    # O DataFrame é montado fora do cache para que quem chama possa alterá-lo
+    anos_unicos, medias, anomalias = anomaly_arrays(cidade, ano_inicio, ano_fim)
+    return pd.DataFrame({"year": anos_unicos, "tempMed": medias, "anomalia": anomalias})
+
+# Acima deste intervalo as séries diárias viram médias semanais no gráfico
+MAX_ANOS_DIARIOS = 5
+
+def downsample_temps(dff, ano_inicio, ano_fim):
+    if ano_fim - ano_inicio <= MAX_ANOS_DIARIOS:
+        return dff
+    return dff.set_index("index")[["tempMax", "tempMed", "tempMin"]].resample("W").mean().reset_index()
+
+def dias_ondas_calor(df):
+    # Primeiro e último dia de onda de calor por cidade
+    g = df[df["isHW"]].groupby("cidade", sort=False, observed=True)["index"].agg(["min", "max"])
+    return {cidade: (ini.date(), fim.date()) for cidade, ini, fim in zip(g.index, g["min"], g["max"])}
+
+HEATMAP_YEARS = np.arange(1981, 2024)
+
+def heatmap_matrix(df):
+    # Matriz densa cidade x ano, indexada pelos códigos da categoria cidade
+    hw = df.loc[df["isHW"], ["cidade", "year"]].dropna()
+    codes = hw["cidade"].cat.codes.to_numpy()
+    cols = hw["year"].to_numpy(dtype=np.int64) - HEATMAP_YEARS[0]
+    dentro = (cols >= 0) & (cols < len(HEATMAP_YEARS))
+    mat = np.zeros((len(cidades), len(HEATMAP_YEARS)), dtype=np.int32)
+    np.add.at(mat, (codes[dentro], cols[dentro]), 1)
+    return mat
+
+def build_heatmap_figure(mat):
+    heatmap_fig = go.Figure(go.Heatmap(
+        z=mat,
+        x=HEATMAP_YEARS,
+        y=cidades,
+        colorscale="OrRd",
+        colorbar=dict(
+            title=dict(text="Dias de Onda de Calor", font=dict(size=14)),
+            tickfont=dict(size=12)
+        ),
+        hovertemplate="Ano: %{x}<br>Cidade: %{y}<br>Dias de Onda de Calor: %{z}<extra></extra>"
+    ))
+    heatmap_fig.update_layout(
+        xaxis=dict(
+            title="Ano",
+            tickangle=45,
+            tickfont=dict(size=10),
+            tickmode="linear",
+            dtick=1,
+            gridcolor="rgba(0,0,0,0.1)"
+        ),
+        yaxis=dict(
+            title="Cidade",
+            tickfont=dict(size=10),
+            automargin=True
+        ),
+        title="Total de Dias de Onda de Calor por Cidade e Ano (1981-2023)",
+        height=600,
+        margin=dict(l=150, r=50, t=100, b=100),
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+        font=dict(size=12),
+        hovermode="closest",
+        hoverlabel=dict(font_size=12)
+    )
+    return heatmap_fig
+
+def hw_cube(df):
+    # Tensor cidade x ano x mês com a contagem de dias de onda de calor
+    hw = df.loc[df["isHW"], ["cidade", "year", "month"]].dropna()
+    ano_inicio = ano_min
+    cube = np.zeros((len(cidades), ano_max - ano_min + 1, 12), dtype=np.int32)
+    np.add.at(cube, (
+        hw["cidade"].cat.codes.to_numpy(),
+        hw["year"].to_numpy(dtype=np.int64) - ano_inicio,
+        hw["month"].to_numpy(dtype=np.int64) - 1
+    ), 1)
+    return {
+        "ano_inicio": ano_inicio,
+        "meses": ALL_MONTHS,
+        "counts": {cidade: cube[i].tolist() for i, cidade in enumerate(cidades)},
+        "template": go.Figure().layout.template.to_plotly_json()
+    }
+
+# Heatmap estático: não depende de cidade/ano, então é calculado uma única vez
+hw_matrix = heatmap_matrix(df)
+heatmap_fig = build_heatmap_figure(hw_matrix)
+hw_cube_data = hw_cube(df)
+
+# Intervalo do calendário por cidade, com o período completo como padrão
+data_min, data_max = df["index"].min().date(), df["index"].max().date()
+HW_RANGES = dias_ondas_calor(df)
+
+# Estações meteorológicas (uma por cidade) para o mapa
+STATIONS = df.groupby("cidade", sort=False, observed=True)[["Lat", "Long"]].first().reset_index()
+station_markers = [
+    dl.Marker(position=(r.Lat, r.Long), children=dl.Tooltip(r.cidade))
+    for r in STATIONS.itertuples(index=False)
+]
+map_center = (df["Lat"].mean(), df["Long"].mean())
 
 # App
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = "Dashboard de Ondas de Calor"
+server = app.server  # Usado pelo Gunicorn (Procfile: app:server)
+print("Aplicativo WSGI inicializado:", server)  # Debug
 
 # Layout
 app.layout = dbc.Container([
@@ -76,11 +227,11 @@ app.layout = dbc.Container([
             html.Label("Selecione o período:"),
             dcc.RangeSlider(
                 id="slider-anos",
-                min=min(anos),
-                max=max(anos),
+                min=ano_min,
+                max=ano_max,
                 step=1,
-                marks={int(a): str(a) for a in anos},
-                value=[min(anos), max(anos)]
+                marks={**{a: str(a) for a in range(ano_min, ano_max + 1, 5)}, ano_max: str(ano_max)},
+                value=[ano_min, ano_max]
             ),
             html.Br(),
 
@@ -91,13 +242,9 @@ app.layout = dbc.Container([
                         dbc.CardBody([
                             dl.Map([
                                 dl.TileLayer(),
-                                dl.LayerGroup([
-                                    dl.Marker(position=(row["Lat"], row["Long"]),
-                                              children=dl.Tooltip(row["cidade"]))
-                                    for _, row in df.drop_duplicates("cidade")[["cidade", "Lat", "Long"]].iterrows()
-                                ])
+                                dl.LayerGroup(station_markers)
                             ], style={"width": "100%", "height": "400px"},
-                               center=(df["Lat"].mean(), df["Long"].mean()), zoom=5),
+                               center=map_center, zoom=5),
                         ])
                     ]),
                     dbc.Card([
@@ -126,13 +273,14 @@ app.layout = dbc.Container([
             html.Label("Selecione a cidade e o ano para o Gráfico Polar e Calendário:"),
             dbc.Row([
                 dbc.Col(dcc.Dropdown(id="cidade-hw", options=[{"label": cidade, "value": cidade} for cidade in cidades], value=cidades[0]), width=6),
-                dbc.Col(dcc.Dropdown(id="ano-hw", options=[{"label": str(ano), "value": ano} for ano in anos], value=anos[-1]), width=6)
+                dbc.Col(dcc.Dropdown(id="ano-hw", options=[{"label": str(ano), "value": ano} for ano in range(ano_min, ano_max + 1)], value=ano_max), width=6)
             ]),
+            dcc.Store(id="hw-cube", data=hw_cube_data),
             html.Br(),
 
             dbc.Row([
                 dbc.Col([
-                    dcc.Loading(dcc.Graph(id="heatmap-hw"))
+                    dcc.Graph(id="heatmap-hw", figure=heatmap_fig)
                 ], width=6),
                 dbc.Col([
                     dcc.Loading(dcc.Graph(id="grafico-polar"))
@@ -145,8 +293,8 @@ app.layout = dbc.Container([
                 dcc.Loading(dcc.DatePickerRange(
                     id="calendario-hw",
                     display_format="DD/MM/YYYY",
-                    min_date_allowed=min(df["index"]).date(),
-                    max_date_allowed=max(df["index"]).date(),
+                    min_date_allowed=data_min,
+                    max_date_allowed=data_max,
                     start_date_placeholder_text="Início",
                     end_date_placeholder_text="Fim"
                 ))
@@ -163,14 +311,18 @@ app.layout = dbc.Container([
      Input("slider-anos", "value")]
 )
 def update_temp(cidade, anos_selecionados):
+    if cidade not in CITY_FRAMES:
+        raise PreventUpdate
     ano_inicio, ano_fim = anos_selecionados
-    dff = df[(df["cidade"] == cidade) & (df["year"] >= ano_inicio) & (df["year"] <= ano_fim)]
+    dff = downsample_temps(city_slice(cidade, ano_inicio, ano_fim), ano_inicio, ano_fim)
 
+    x = dff["index"].to_numpy()
     fig_temp = go.Figure()
-    fig_temp.add_trace(go.Scatter(x=dff["index"], y=dff["tempMax"], name="Máxima", line=dict(color="red")))
-    fig_temp.add_trace(go.Scatter(x=dff["index"], y=dff["tempMed"], name="Média", line=dict(color="blue")))
-    fig_temp.add_trace(go.Scatter(x=dff["index"], y=dff["tempMin"], name="Mínima", line=dict(color="green")))
+    fig_temp.add_trace(go.Scatter(x=x, y=dff["tempMax"].to_numpy(), name="Máxima", line=dict(color="red")))
+    fig_temp.add_trace(go.Scatter(x=x, y=dff["tempMed"].to_numpy(), name="Média", line=dict(color="blue")))
+    fig_temp.add_trace(go.Scatter(x=x, y=dff["tempMin"].to_numpy(), name="Mínima", line=dict(color="green")))
     fig_temp.update_layout(
+        uirevision=cidade,
         title=f"Temperaturas em {cidade} ({ano_inicio}-{ano_fim})",
         xaxis_title="Data",
         yaxis_title="Temperatura (°C)",
@@ -179,7 +331,7 @@ def update_temp(cidade, anos_selecionados):
         font=dict(size=12)
     )
 
-    df_anomalia = calculate_anomalies(df, cidade, ano_inicio, ano_fim)
+    df_anomalia = calculate_anomalies(cidade, ano_inicio, ano_fim)
     fig_anomalia = px.scatter(
         df_anomalia, x="year", y="anomalia", size=np.abs(df_anomalia["anomalia"]),
         title=f"Anomalias de Temperatura Média - {cidade} ({ano_inicio}-{ano_fim})",
@@ -192,98 +344,62 @@ def update_temp(cidade, anos_selecionados):
     )
     return fig_temp, fig_anomalia
 
+# Gráfico polar montado no navegador a partir do hw-cube, sem ida ao servidor
+app.clientside_callback(
+    """
+    function(cidade, ano, cube) {
+        if (!cube || !cube.counts[cidade]) {
+            return window.dash_clientside.no_update;
+        }
+        const r = cube.counts[cidade][ano - cube.ano_inicio] || new Array(12).fill(0);
+        return {
+            data: [{
+                type: "scatterpolar",
+                r: r,
+                theta: cube.meses,
+                fill: "toself",
+                mode: "lines+markers",
+                line: {color: "blue", width: 2},
+                marker: {color: "blue", size: 8},
+                name: "Frequência"
+            }],
+            layout: {
+                template: cube.template,
+                title: {text: `Frequência de Ondas de Calor em ${cidade} - ${ano}`},
+                polar: {
+                    radialaxis: {visible: true, tickfont: {size: 10}},
+                    angularaxis: {direction: "clockwise", tickfont: {size: 10}}
+                },
+                showlegend: false,
+                height: 400,
+                margin: {l: 50, r: 50, t: 100, b: 50},
+                plot_bgcolor: "white",
+                paper_bgcolor: "white",
+                font: {size: 12}
+            }
+        };
+    }
+    """,
+    Output("grafico-polar", "figure"),
+    [Input("cidade-hw", "value"),
+     Input("ano-hw", "value"),
+     Input("hw-cube", "data")]
+)
+
 @app.callback(
-    [Output("heatmap-hw", "figure"),
-     Output("grafico-polar", "figure"),
-     Output("calendario-hw", "start_date"),
+    [Output("calendario-hw", "start_date"),
      Output("calendario-hw", "end_date"),
      Output("calendario-hw", "min_date_allowed"),
      Output("calendario-hw", "max_date_allowed")],
-    [Input("cidade-hw", "value"),
-     Input("ano-hw", "value")]
+    [Input("cidade-hw", "value")]
 )
-def update_hw(cidade, ano_polar):
-    # Heatmap
-    df_heatmap = prepare_heatmap_data(df)
-    max_dias_hw = max(df_heatmap["dias_hw"], default=1)
-    
-    heatmap_fig = px.density_heatmap(
-        df_heatmap,
-        x="year",
-        y="cidade",
-        z="dias_hw",
-        color_continuous_scale="OrRd",
-        labels={"dias_hw": "Dias de Onda de Calor"},
-        title="Total de Dias de Onda de Calor por Cidade e Ano (1981-2023)"
-    )
-    heatmap_fig.update_layout(
-        xaxis=dict(
-            title="Ano",
-            tickangle=45,
-            tickfont=dict(size=10),
-            tickmode="linear",
-            dtick=1,
-            gridcolor="rgba(0,0,0,0.1)"
-        ),
-        yaxis=dict(
-            title="Cidade",
-            tickfont=dict(size=10),
-            automargin=True
-        ),
-        coloraxis_colorbar=dict(
-            title=dict(text="Dias de Onda de Calor", font=dict(size=14)),
-            tickfont=dict(size=12)
-        ),
-        height=600,
-        margin=dict(l=150, r=50, t=100, b=100),
-        plot_bgcolor="white",
-        paper_bgcolor="white",
-        font=dict(size=12),
-        hovermode="closest",
-        hoverlabel=dict(font_size=12)
-    )
-
-    # Polar plot
-    df_polar = calculate_hw_monthly(df, cidade, ano_polar)
-    
-    fig_polar = go.Figure()
-    fig_polar.add_trace(go.Scatterpolar(
-        r=df_polar["frequencia"],
-        theta=df_polar["mes"],
-        fill="toself",
-        mode="lines+markers",
-        line=dict(color="blue", width=2),
-        marker=dict(color="blue", size=8),
-        name="Frequência"
-    ))
-    fig_polar.update_layout(
-        title=f"Frequência de Ondas de Calor em {cidade} - {ano_polar}",
-        polar=dict(
-            radialaxis=dict(visible=True, tickfont=dict(size=10)),
-            angularaxis=dict(direction="clockwise", tickfont=dict(size=10))
-        ),
-        showlegend=False,
-        height=400,
-        margin=dict(l=50, r=50, t=100, b=50),
-        plot_bgcolor="white",
-        paper_bgcolor="white",
-        font=dict(size=12)
-    )
-
+def update_hw(cidade):
     # Calendário
-    dias_calor = dias_ondas_calor(df, cidade)
-    if dias_calor:
-        min_date = min(dias_calor)
-        max_date = max(dias_calor)
-    else:
-        min_date = min(df["index"]).date()
-        max_date = max(df["index"]).date()
-    
-    return heatmap_fig, fig_polar, min_date, max_date, min_date, max_date
+    min_date, max_date = HW_RANGES.get(cidade, (data_min, data_max))
+    return min_date, max_date, min_date, max_date
 
 # Rodar App
 # Rodar App com Gunicorn (não use app.run() em produção)
-import os
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8050))
     print(f"Iniciando servidor na porta {port}")  # Debug